@@ -15,44 +15,97 @@
 # limitations under the License.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import json
 import os
 import pathlib
 import subprocess
 import sys
+from typing import Iterator
 from typing import List
-import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 IKOS_MARKER_FILE_EXT = '.ikosbin'
 IKOS_DB_FILE_EXT = '.ikosdb'
 
 
+# Newline plus indentation for each nesting level, to avoid building the same strings repeatedly
+INDENT_CACHE = ['\n' + level * '  ' for level in range(64)]
+
+
+def indentation(level):
+    """Return the newline and indentation string for a nesting level."""
+    return INDENT_CACHE[level] if level < len(INDENT_CACHE) else '\n' + level * '  '
+
+
 def indent(elem, level=0):
     """Use a low-budget method to format the XML to avoid bringing in another library (stack overflow #3095434)."""
-    i = '\n' + level * '  '
-    if len(elem):
+    if (len(elem) or level) and (not elem.tail or not elem.tail.strip()):
+        elem.tail = indentation(level)
+
+    # Walk the tree with an explicit stack instead of recursing, where each element indents its
+    # text and the tails of its children
+    stack = [(elem, level)]
+    while stack:
+        elem, level = stack.pop()
+        if not len(elem):
+            continue
+        child_indentation = indentation(level + 1)
         if not elem.text or not elem.text.strip():
-            elem.text = i + '  '
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+            elem.text = child_indentation
+        for child in elem:
+            if not child.tail or not child.tail.strip():
+                child.tail = child_indentation
+            stack.append((child, level + 1))
+        if not child.tail.strip():
+            child.tail = indentation(level)
+
+
+def walk_marker_files(directory: str) -> Iterator[str]:
+    """Yield the paths of the marker files in a directory tree, skipping CMakeFiles directories."""
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # Skip the CMake compiler test files without descending into their directories
+                if entry.name != 'CMakeFiles':
+                    yield from walk_marker_files(entry.path)
+            elif entry.name.endswith(IKOS_MARKER_FILE_EXT):
+                yield entry.path
 
 
 def scan_marker_files(directory: str) -> List[pathlib.Path]:
     """Return a list of marker files in a target directory."""
-    def remove_cmake_compiler_test_files(path: pathlib.Path) -> bool:
-        if '/CMakeFiles/' in str(path):
-            return False
-        else:
-            return True
+    # Sort the plain strings by their components, which gives the same order as sorting the Path
+    # objects would, and only create the Path objects for the final list
+    marker_files = sorted(walk_marker_files(directory), key=lambda path: path.split(os.sep))
+    return [pathlib.Path(marker_file) for marker_file in marker_files]
+
+
+def ikos_db_stem(ikos_db_path):
+    """Return the path of an IKOS database without its extension."""
+    # The databases are always named after the executable with IKOS_DB_FILE_EXT appended
+    return ikos_db_path[:-len(IKOS_DB_FILE_EXT)]
 
-    return list(filter(remove_cmake_compiler_test_files, sorted(pathlib.Path(directory).glob('**/*' + IKOS_MARKER_FILE_EXT))))
+
+def ikos_report_filename(ikos_db_path, format_ext):
+    """Return the name of the report file in a given format for an IKOS database."""
+    return f'{ikos_db_stem(ikos_db_path)}.{format_ext}'
 
 
 def run_ikos(bitcode_path, ikos_db_path):
@@ -61,136 +114,199 @@ def run_ikos(bitcode_path, ikos_db_path):
     # to avoid generating a report to stdout here and we'll do it later using a separate ikos-report
     cmd = ['ikos', bitcode_path, '-o', ikos_db_path, '-q', '--format', 'no']
 
-    rc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    # The output is only of interest if the analysis fails, so only decode it then
+    rc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     if rc.returncode != 0:
         print(
             'ikos analysis error: "' + ' '.join(cmd) +
             '" exited with return code ' + str(rc.returncode))
-        print(rc.stdout)
+        print(rc.stdout.decode('utf-8', errors='replace'))
         return False
     return True
 
 
 def generate_ikos_stdout(ikos_db_path):
-    """Run the IKOS report generator to print the issue list to stdout."""
-    rc = subprocess.run(['ikos-report', ikos_db_path])
-    if rc.returncode != 0:
-        pass
+    """Start the IKOS report generator to collect the issue list for stdout."""
+    # Capture the report so that the output of analyses running in parallel doesn't interleave
+    return subprocess.Popen(
+        ['ikos-report', ikos_db_path], stdout=subprocess.PIPE, universal_newlines=True)
 
 
 def generate_ikos_report(ikos_db_path, fmt='junit', format_ext='junit.xml'):
-    """Generate an IKOS report in one of the IKOS-supported formats (we use JUnit XML and SARIF)."""
-    report_filename = f'{os.path.splitext(ikos_db_path)[0]}.{format_ext}'
+    """Start an IKOS report in one of the IKOS-supported formats (we use JUnit XML and SARIF)."""
+    report_filename = ikos_report_filename(ikos_db_path, format_ext)
     cmd = ['ikos-report', '--format', fmt, '--report-file', report_filename]
 
     # The target database must be the last argument, after the flags
     cmd.append(ikos_db_path)
 
-    rc = subprocess.run(cmd)
-    if rc.returncode != 0:
-        pass
+    return subprocess.Popen(cmd)
 
 
 def process_marker_file(marker_file, args):
     """Generate the stdout as well as optional JUnit XML and SARIF output files."""
-    with marker_file.open() as jsonf:
-        data = json.load(jsonf)
-        bc_path = data['bc']
-        ikos_db_path = data['exe'] + IKOS_DB_FILE_EXT
-
-        if run_ikos(bc_path, ikos_db_path):
-            # Run the ikos reporting tool to generate the stdout for the issues
-            generate_ikos_stdout(ikos_db_path)
-
-            # Generate JUnit XML and SARIF files, as requested
-            if args.xunit_file:
-                generate_ikos_report(ikos_db_path, 'junit', 'junit.xml')
-            if args.sarif_file:
-                generate_ikos_report(ikos_db_path, 'sarif', 'sarif')
-
-            return ikos_db_path
-        else:
-            print('Cannot generate report for ' + bc_path + ' due to analysis failure.')
+    data = json_loads(marker_file.read_bytes())
+    bc_path = data['bc']
+    ikos_db_path = data['exe'] + IKOS_DB_FILE_EXT
+
+    if run_ikos(bc_path, ikos_db_path):
+        # The reports only read the finished database, so generate them all concurrently.
+        # Start by running the ikos reporting tool to generate the stdout for the issues, unless
+        # it is not wanted.
+        stdout_report = None if args.quiet else generate_ikos_stdout(ikos_db_path)
+
+        # Generate JUnit XML and SARIF files, as requested
+        reports = []
+        if args.xunit_file:
+            reports.append(generate_ikos_report(ikos_db_path, 'junit', 'junit.xml'))
+        if args.sarif_file:
+            reports.append(generate_ikos_report(ikos_db_path, 'sarif', 'sarif'))
+
+        if stdout_report:
+            output, _ = stdout_report.communicate()
+            print(output, end='', flush=True)
+        for report in reports:
+            report.wait()
+
+        return ikos_db_path
+    else:
+        print('Cannot generate report for ' + bc_path + ' due to analysis failure.')
+
+
+def pin_to_next_cpu(cpus):
+    """Pin the calling thread, and the processes that it starts, to the next CPU of an iterator."""
+    # On Linux, pid 0 refers to the calling thread rather than the whole process
+    os.sched_setaffinity(0, {next(cpus)})
 
 
 def aggregate_junit_xml_files(ikos_db_filenames, summary_filename, summary_name):
     """Aggregate the JUnit XML files for each test into a single ikos.junit.xml file."""
+    # Counters to aggregate the test suite results for all test suites
+    total_tests = 0
+    total_errors = 0
+    total_failures = 0
+    total_time = 0.0
+
+    # The summary attributes of the <testsuites> element have to be written before the test suites
+    # themselves, so first make a pass over the file that was output by IKOS for each test to tally
+    # the results without keeping the parsed test cases around
+    junit_xml_files = []
+    for db_filename in ikos_db_filenames:
+        db_stem = ikos_db_stem(db_filename)
+        junit_xml_filename = db_stem + '.junit.xml'
+
+        failure_count = 0
+        for _, elem in ET.iterparse(junit_xml_filename):
+            if elem.tag == 'failure':
+                failure_count += 1
+            elif elem.tag == 'testcase':
+                elem.clear()
+
+        # The root element, which is written out as the test suite for this file, is the last one
+        # to be closed. Only count its results, so that each file is tallied exactly once.
+        attrib = elem.attrib
+        total_tests += int(attrib['tests'])
+        total_errors += int(attrib['errors'])
+        total_failures += failure_count
+        total_time += float(attrib['time'])
+
+        junit_xml_files.append((db_stem, junit_xml_filename, failure_count))
+
     with open(summary_filename, 'wb') as xunit_file:
         # Wrap all of the concatenated XML output files with a <testsuites> element
-        top = ET.Element('testsuites')
-
-        # Counters to aggregate the test suite results for all test suites
-        total_tests = 0
-        total_errors = 0
-        total_failures = 0
-        total_time = 0.0
-
-        # Set the attributes for the <testsuites> element
-        top.attrib['name'] = summary_name
-
-        # Handle the file that was output by IKOS for each test
-        for db_filename in ikos_db_filenames:
-            junit_xml_filename = os.path.splitext(db_filename)[0] + '.junit.xml'
-
-            tree = ET.parse(junit_xml_filename)
-            root = tree.getroot()
+        top_attrib = {
+            'name': summary_name,
+            'tests': str(total_tests),
+            'errors': str(total_errors),
+            'failures': str(total_failures),
+            'time': str(total_time),
+        }
+        xunit_file.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+        top_attrs = ''.join(f' {key}={quoteattr(value)}' for key, value in top_attrib.items())
+        xunit_file.write(f'<testsuites{top_attrs}>\n'.encode('utf-8'))
+
+        # lxml parsers can be reused across documents, which saves setting up a new parser for each
+        # file. The standard library parsers can only be used once, so let it create them.
+        parser = ET.XMLParser(remove_blank_text=True) if hasattr(ET, 'LXML_VERSION') else None
+
+        # Stream each <testsuite> node into the output, so only one of them is in memory at a time
+        for db_stem, junit_xml_filename, failure_count in junit_xml_files:
+            root = ET.parse(junit_xml_filename, parser).getroot()
 
             # Replace the default testsuite name with the program name that was run under IKOS
-            root.attrib['name'] = os.path.basename(os.path.splitext(db_filename)[0])
+            root.attrib['name'] = os.path.basename(db_stem)
 
             # Work around a bug in the IKOS output where the failures are not reported correctly.
-            # Instead of using the summary value, count the number of failure nodes.
-            root.attrib['failures'] = str(len(root.findall('.//failure')))
-
-            total_tests += int(root.attrib['tests'])
-            total_errors += int(root.attrib['errors'])
-            total_failures += int(root.attrib['failures'])
-            total_time += float(root.attrib['time'])
+            # Instead of using the summary value, use the number of failure nodes.
+            root.attrib['failures'] = str(failure_count)
 
-            # Add the <testsuite> node to the parent <testsuites> node
-            top.append(root)
+            # ElementTree.indent is only available from Python 3.9
+            if hasattr(ET, 'indent'):
+                ET.indent(root, space='  ', level=1)
+            else:
+                indent(root, level=1)
+            root.tail = '\n'
 
-        # Update summary fields for the top-level <testsuites>
-        top.attrib['tests'] = str(total_tests)
-        top.attrib['errors'] = str(total_errors)
-        top.attrib['failures'] = str(total_failures)
-        top.attrib['time'] = str(total_time)
+            xunit_file.write(b'  ')
+            ET.ElementTree(root).write(xunit_file, encoding='utf-8', xml_declaration=False)
 
-        indent(top)
-        xunit_file.write(ET.tostring(top, encoding='utf8', method='xml'))
+        xunit_file.write(b'</testsuites>\n')
 
 
 def aggregate_sarif_files(ikos_db_filenames, summary_filename, summary_name):
     """Aggregate the SARIF files for each test into a single output SARIF file."""
-    first = True
-    output_dict = {}
+    # Write the output envelope by hand and stream the 'runs' of each input file into it, so that
+    # only one of the input files is in memory at a time. The output is formatted the same way as
+    # json.dump(..., indent=2) would format the whole document. That is why the SARIF files are
+    # handled with json rather than orjson, which escapes strings and handles big integers
+    # differently.
+    with open(summary_filename, 'w') as outfile:
+        first = True
+        for db_filename in ikos_db_filenames:
+            # Generate the input SARIF filename from the IKOS db name
+            sarif_filename = ikos_db_stem(db_filename) + '.sarif'
 
-    for db_filename in ikos_db_filenames:
-        # Generate the input SARIF filename from the IKOS db name
-        sarif_filename = os.path.splitext(db_filename)[0] + '.sarif'
+            # Process the file
+            with open(sarif_filename) as input_file:
+                data = json.load(input_file)
 
-        # Process the file
-        with open(sarif_filename) as input_file:
-            data = json.load(input_file)
             # Grab the version and schema information from the first file
             if first:
-                output_dict['version'] = data['version']
-                output_dict['$schema'] = data['$schema']
-                output_dict['runs'] = []
+                version = data['version']
+                schema = data['$schema']
+                outfile.write(
+                    '{\n  "version": ' + json.dumps(version) +
+                    ',\n  "$schema": ' + json.dumps(schema) +
+                    ',\n  "runs": [')
+                separator = '\n    '
                 first = False
             else:
-                assert output_dict['version'] == data['version'], \
-                    f"SARIF version mismatch in input files: {output_dict['version']} vs. {data['version']}"
-                assert output_dict['$schema'] == data['$schema'], \
-                    f"SARIF schema mismatch in input files: {output_dict['$schema']} vs. {data['$schema']}"
+                assert version == data['version'], \
+                    f"SARIF version mismatch in input files: {version} vs. {data['version']}"
+                assert schema == data['$schema'], \
+                    f"SARIF schema mismatch in input files: {schema} vs. {data['$schema']}"
 
-            # Integrate the 'runs' data from each separate IKOS scan
+            # Integrate the 'runs' data from each separate IKOS scan. Serialized JSON can't contain
+            # a raw newline inside a string, so each line can safely be indented to the runs level.
             for run in data['runs']:
-                output_dict['runs'].append(run)
+                outfile.write(separator + json.dumps(run, indent=2).replace('\n', '\n    '))
+                separator = ',\n    '
+
+        # Close the envelope, matching json.dump's output for an empty document or 'runs' list
+        if first:
+            outfile.write('{}')
+        elif separator == '\n    ':
+            outfile.write(']\n}')
+        else:
+            outfile.write('\n  ]\n}')
 
-    # Dump the output dictionary as a single SARIF (json) file
-    with open(summary_filename, 'w') as outfile:
-        json.dump(output_dict, outfile, indent=2)
+
+def positive_int(value: str) -> int:
+    """Convert a command line argument to an integer, rejecting values smaller than 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
 
 
 def main(argv=sys.argv[1:]) -> int:
@@ -207,6 +323,20 @@ def main(argv=sys.argv[1:]) -> int:
     parser.add_argument(
         '--sarif-file',
         help='Generate a SARIF-compliant output file')
+    parser.add_argument(
+        '--quiet', '-q',
+        action='store_true',
+        help="Don't print the issues found in each analyzed file, e.g. when only the "
+             'xunit/SARIF output files are of interest')
+    parser.add_argument(
+        '--jobs', '-j',
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help='Number of marker files to analyze in parallel (1 analyzes them serially)')
+    parser.add_argument(
+        '--pin-cores',
+        action='store_true',
+        help='Pin each parallel analysis to its own CPU core to keep its caches warm (Linux only)')
     args = parser.parse_args(argv)
 
     ikos_db_files = []
@@ -217,9 +347,32 @@ def main(argv=sys.argv[1:]) -> int:
         print('No marker files found when scanning ' + args.directory)
         return 0
 
-    # Process each one
-    for m in marker_files:
-        result = process_marker_file(m, args)
+    # Process each one, running the independent IKOS analyses in parallel. The results are
+    # collected in the order of the marker files to keep the aggregated output deterministic.
+    # Each thread running analyses pins itself to a CPU, which the ikos processes that it starts
+    # inherit
+    initializer = None
+    initargs = ()
+    if args.pin_cores:
+        if hasattr(os, 'sched_setaffinity'):
+            initializer = pin_to_next_cpu
+            initargs = (itertools.cycle(sorted(os.sched_getaffinity(0))),)
+        else:
+            print('Pinning the analyses to CPU cores is not supported on this platform')
+
+    jobs = min(args.jobs, len(marker_files))
+    if jobs > 1:
+        with ThreadPoolExecutor(
+                max_workers=jobs, initializer=initializer, initargs=initargs) as executor:
+            results = list(executor.map(lambda m: process_marker_file(m, args), marker_files))
+    else:
+        # Don't bother with a thread pool for a single job, which also keeps debugging simple.
+        # The main thread runs the analyses, so it is the one to pin.
+        if initializer:
+            initializer(*initargs)
+        results = [process_marker_file(m, args) for m in marker_files]
+
+    for result in results:
         if result:
             ikos_db_files.append(result)
 
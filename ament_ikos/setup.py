@@ -12,6 +12,12 @@ setup(
         ('share/' + package_name, ['package.xml']),
     ],
     install_requires=['setuptools'],
+    extras_require={
+        # Faster parsing and serialization of the JUnit XML files
+        'lxml': ['lxml'],
+        # Faster JSON parsing of the IKOS marker files
+        'orjson': ['orjson'],
+    },
     zip_safe=True,
     maintainer='Steven! Ragnarök',
     maintainer_email='steven@openrobotics.org',